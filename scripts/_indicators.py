@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+_indicators.py - Compiled technical indicator kernels
+Uses Numba when it is installed; otherwise the same loops run as plain Python
+"""
+
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional - fall back to the undecorated function
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda func: func
+
+@njit(cache=True)
+def rsi_last(close, period):
+    """
+    Latest Wilder RSI of a float64 close array (needs at least period + 1 closes)
+    Seeds the average gain/loss with the simple mean of the first period deltas,
+    then smooths: avg = (avg * (period - 1) + value) / period
+    """
+    avg_gain = 0.0
+    avg_loss = 0.0
+    for i in range(1, period + 1):
+        delta = close[i] - close[i - 1]
+        if delta > 0:
+            avg_gain += delta
+        else:
+            avg_loss -= delta
+    avg_gain /= period
+    avg_loss /= period
+
+    for i in range(period + 1, len(close)):
+        delta = close[i] - close[i - 1]
+        gain = delta if delta > 0 else 0.0
+        loss = -delta if delta < 0 else 0.0
+        avg_gain = (avg_gain * (period - 1) + gain) / period
+        avg_loss = (avg_loss * (period - 1) + loss) / period
+
+    if avg_loss == 0:
+        # A flat window (no gains either) is neutral, not overbought
+        return 50.0 if avg_gain == 0 else 100.0
+    return 100.0 - 100.0 / (1.0 + avg_gain / avg_loss)
+
+def rolling_mean_tail(values, window):
+    """Last value of a trailing rolling mean (averages what is there if len < window)"""
+    return values[-window:].mean()
@@ -5,15 +5,20 @@ Sends alerts for price movements, technical indicators, and trading signals
 """
 
 import smtplib
-import snowflake.connector
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+import hashlib
+import socket
+import ssl
+import atexit
+from snowflake_conn import get_conn
+from email.message import EmailMessage
 from datetime import datetime, timedelta
 import os
 import logging
-import json
+import sqlite3
 import traceback
-import pytz
+from zoneinfo import ZoneInfo
+import numpy as np
+from string import Template
 from typing import Dict, List, Optional, Tuple
 
 # Configure logging
@@ -23,124 +28,287 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Static email skeleton, compiled once at import; format_email_html only renders the
+# dynamic fragments and substitutes them in. Literal dollar signs are written as $$.
+_HTML_TEMPLATE = Template("""
+        <html>
+        <head>
+            <style>
+                body { font-family: Arial, sans-serif; background-color: #f4f4f4; padding: 20px; }
+                .container { background-color: white; border-radius: 10px; padding: 20px; max-width: 600px; margin: 0 auto; }
+                .header { background: linear-gradient(135deg, #0071ce 0%, #005a9c 100%); color: white; padding: 20px; border-radius: 10px 10px 0 0; margin: -20px -20px 20px -20px; }
+                .walmart-logo { font-size: 24px; font-weight: bold; color: white; }
+                .price-info { background-color: #f8f9fa; padding: 15px; border-radius: 8px; margin: 20px 0; }
+                .alert-high { border-left: 4px solid #dc3545; padding: 10px; margin: 10px 0; background-color: #fff5f5; }
+                .alert-medium { border-left: 4px solid #ffc107; padding: 10px; margin: 10px 0; background-color: #fffdf5; }
+                .metric { display: inline-block; margin: 10px 20px 10px 0; }
+                .metric-label { color: #666; font-size: 12px; }
+                .metric-value { font-size: 18px; font-weight: bold; color: #333; }
+                .footer { margin-top: 30px; padding-top: 20px; border-top: 1px solid #ddd; font-size: 12px; color: #666; }
+                .button { background-color: #0071ce; color: white; padding: 10px 20px; text-decoration: none; border-radius: 5px; display: inline-block; margin: 10px 0; }
+            </style>
+        </head>
+        <body>
+            <div class="container">
+                <div class="header">
+                    <div style="display: flex; align-items: center; gap: 15px;">
+                        <svg width="50" height="50" viewBox="0 0 50 50" style="flex-shrink: 0;">
+                            <circle cx="25" cy="25" r="25" fill="#FFC220"/>
+                            <g transform="translate(25, 25)">
+                                <!-- Walmart spark/star pattern -->
+                                <rect x="-3" y="-12" width="6" height="8" rx="3" fill="#0071CE"/>
+                                <rect x="-3" y="4" width="6" height="8" rx="3" fill="#0071CE"/>
+                                <rect x="-12" y="-3" width="8" height="6" rx="3" fill="#0071CE" transform="rotate(90 0 0)"/>
+                                <rect x="4" y="-3" width="8" height="6" rx="3" fill="#0071CE" transform="rotate(90 0 0)"/>
+                                <rect x="-10" y="-10" width="8" height="6" rx="3" fill="#0071CE" transform="rotate(45 0 0)"/>
+                                <rect x="4" y="4" width="8" height="6" rx="3" fill="#0071CE" transform="rotate(45 0 0)"/>
+                                <rect x="-10" y="4" width="8" height="6" rx="3" fill="#0071CE" transform="rotate(-45 0 0)"/>
+                                <rect x="4" y="-10" width="8" height="6" rx="3" fill="#0071CE" transform="rotate(-45 0 0)"/>
+                            </g>
+                        </svg>
+                        <div>
+                            <div class="walmart-logo">Walmart Stock Alerts</div>
+                            <div style="font-size: 12px; opacity: 0.9; margin-top: 2px;">NYSE: WMT</div>
+                        </div>
+                    </div>
+                    <div style="font-size: 14px; margin-top: 15px; padding-top: 15px; border-top: 1px solid rgba(255,255,255,0.2);">
+                        <div style="font-weight: bold;">$timestamp</div>
+                        <div style="font-size: 12px; opacity: 0.9; margin-top: 3px;">Central $dst_name Time (C${dst_letter}T) • Bentonville, AR</div>
+                    </div>
+                </div>
+                
+                <div class="price-info">
+                    <div class="metric">
+                        <div class="metric-label">Current Price</div>
+                        <div class="metric-value">$current_price</div>
+                    </div>
+                    <div class="metric">
+                        <div class="metric-label">Change</div>
+                        <div class="metric-value" style="color: $change_color;">
+                            $change
+                        </div>
+                    </div>
+                    <div class="metric">
+                        <div class="metric-label">Volume</div>
+                        <div class="metric-value">$volume</div>
+                    </div>
+                </div>
+        $alerts
+                <h3>📊 Key Metrics</h3>
+                <table style="width: 100%; border-collapse: collapse;">
+                    <tr>
+                        <td style="padding: 8px; border-bottom: 1px solid #ddd;">
+                            <strong>RSI (14)</strong>
+                        </td>
+                        <td style="padding: 8px; border-bottom: 1px solid #ddd; text-align: right;">
+                            $rsi
+                        </td>
+                    </tr>
+                    <tr>
+                        <td style="padding: 8px; border-bottom: 1px solid #ddd;">
+                            <strong>MA50</strong>
+                        </td>
+                        <td style="padding: 8px; border-bottom: 1px solid #ddd; text-align: right;">
+                            $ma50
+                        </td>
+                    </tr>
+                    <tr>
+                        <td style="padding: 8px; border-bottom: 1px solid #ddd;">
+                            <strong>MA200</strong>
+                        </td>
+                        <td style="padding: 8px; border-bottom: 1px solid #ddd; text-align: right;">
+                            $ma200
+                        </td>
+                    </tr>
+                    <tr>
+                        <td style="padding: 8px; border-bottom: 1px solid #ddd;">
+                            <strong>52-Week Range</strong>
+                        </td>
+                        <td style="padding: 8px; border-bottom: 1px solid #ddd; text-align: right;">
+                            $range_52w
+                        </td>
+                    </tr>
+                    <tr>
+                        <td style="padding: 8px;">
+                            <strong>Volume Ratio</strong>
+                        </td>
+                        <td style="padding: 8px; text-align: right;">
+                            $volume_ratio
+                        </td>
+                    </tr>
+                </table>
+                
+                <div style="text-align: center; margin-top: 30px;">
+                    <a href="https://finance.yahoo.com/quote/WMT" class="button">View on Yahoo Finance</a>
+                </div>
+                
+                <div class="footer">
+                    <p>This is an automated alert from your Walmart Stock Monitoring System.</p>
+                    <p>Alert thresholds: $thresholds</p>
+                    <p>To modify alert settings, update the environment variables in your configuration.</p>
+                </div>
+            </div>
+        </body>
+        </html>
+        """)
+
+# Numeric fields the alert rules compare. Missing and zero values become NaN, so any
+# rule touching them evaluates to False - the vectorized form of the old truthiness
+# guards (a 0.0 pct_from_52w_high, an RSI of 0 or a zero previous close never fire).
+_ALERT_FIELDS = (
+    'price_change_pct', 'volume_ratio', 'rsi_14', 'ma50', 'ma200', 'current_price',
+    'pct_from_52w_high', 'pct_from_52w_low', 'open', 'close',
+)
+
+def _alert_records(rows: List[Optional[Dict]]) -> np.recarray:
+    """Pack one row per symbol into a float record array keyed by _ALERT_FIELDS"""
+    return np.rec.fromrecords(
+        [tuple(float(row[f]) if row and row.get(f) else np.nan for f in _ALERT_FIELDS)
+         for row in rows],
+        names=_ALERT_FIELDS
+    )
+
+_ALERT_SECTIONS = (
+    ('HIGH', 'alert-high', '🚨 High Priority Alerts'),
+    ('MEDIUM', 'alert-medium', '⚠️ Medium Priority Alerts'),
+)
+
 class StockAlertSystem:
     """Alert system for monitoring Walmart stock and sending email notifications"""
     
     def __init__(self):
         """Initialize alert system with configuration"""
-        # Email configuration - Fixed to handle empty SMTP_SERVER
-        smtp_server = os.environ.get('SMTP_SERVER', 'smtp.gmail.com')
-        self.smtp_server = smtp_server if smtp_server and smtp_server.strip() else 'smtp.gmail.com'
-        # Fixed: Handle empty string or missing SMTP_PORT
-        smtp_port_str = os.environ.get('SMTP_PORT', '587')
-        self.smtp_port = int(smtp_port_str) if smtp_port_str and smtp_port_str.strip() else 587
+        # Email configuration and alert thresholds (customizable via environment variables).
+        # Empty strings fall back to the defaults as well as missing variables.
+        for attr, key, default, cast in (
+            ('smtp_server', 'SMTP_SERVER', 'smtp.gmail.com', str),
+            ('smtp_port', 'SMTP_PORT', 587, int),
+            ('price_change_threshold', 'PRICE_CHANGE_THRESHOLD', 2.0, float),
+            ('volume_spike_threshold', 'VOLUME_SPIKE_THRESHOLD', 1.5, float),
+            ('rsi_oversold', 'RSI_OVERSOLD', 30.0, float),
+            ('rsi_overbought', 'RSI_OVERBOUGHT', 70.0, float),
+            ('dedup_window_seconds', 'DEDUP_WINDOW_SECONDS', 1800, int),
+            ('rate_limit_per_min', 'ALERT_RATE_LIMIT_PER_MIN', 10, int),
+            ('smtp_timeout', 'SMTP_TIMEOUT', 10.0, float),
+        ):
+            setattr(self, attr, self._env(key, default, cast))
         
         self.sender_email = os.environ.get('SENDER_EMAIL')
         self.sender_password = os.environ.get('SENDER_PASSWORD')  # App-specific password for Gmail
         recipient_str = os.environ.get('RECIPIENT_EMAILS', '')
         self.recipient_emails = [email.strip() for email in recipient_str.split(',') if email.strip()]
         
-        # Alert thresholds (can be customized via environment variables)
-        # Fixed: Handle empty strings for all threshold values
-        price_threshold = os.environ.get('PRICE_CHANGE_THRESHOLD', '2.0')
-        self.price_change_threshold = float(price_threshold) if price_threshold and price_threshold.strip() else 2.0
-        
-        volume_threshold = os.environ.get('VOLUME_SPIKE_THRESHOLD', '1.5')
-        self.volume_spike_threshold = float(volume_threshold) if volume_threshold and volume_threshold.strip() else 1.5
+        # Clock reading shared by everything in one run(); refreshed at the top of run()
+        self._now = datetime.now()
+        self._today = self._now.strftime('%Y-%m-%d')
         
-        rsi_oversold_str = os.environ.get('RSI_OVERSOLD', '30')
-        self.rsi_oversold = float(rsi_oversold_str) if rsi_oversold_str and rsi_oversold_str.strip() else 30.0
+        # Track sent alerts to avoid duplicates (keyed SQLite store, one row per day/type)
+        self.alert_history_file = 'alert_history.db'
+        self._history_db = self.open_alert_history()
         
-        rsi_overbought_str = os.environ.get('RSI_OVERBOUGHT', '70')
-        self.rsi_overbought = float(rsi_overbought_str) if rsi_overbought_str and rsi_overbought_str.strip() else 70.0
+        # SMTP connection method ('ssl' or 'starttls'), remembered per server once one works
+        self._smtp_mode_key = f"smtp_mode:{self.smtp_server}:{self.smtp_port}"
+        self._smtp_mode = self._load_setting(self._smtp_mode_key) or ('ssl' if self.smtp_port == 465 else 'starttls')
         
-        # Track sent alerts to avoid duplicates
-        self.alert_history_file = 'alert_history.json'
-        self.alert_history = self.load_alert_history()
+        # Logged-in SMTP client reused across run() calls (see _get_smtp)
+        self._smtp = None
+        atexit.register(self._close_smtp)
         
         # Log configuration
         logger.info(f"SMTP Server: {self.smtp_server}:{self.smtp_port}")
         logger.info(f"Sender Email: {self.sender_email}")
         logger.info(f"Recipients: {self.recipient_emails}")
         
-    def load_alert_history(self) -> Dict:
-        """Load alert history from file"""
-        if os.path.exists(self.alert_history_file):
-            try:
-                with open(self.alert_history_file, 'r') as f:
-                    return json.load(f)
-            except Exception as e:
-                logger.warning(f"Could not load alert history: {e}")
-        return {}
+    @staticmethod
+    def _env(key: str, default, cast=str):
+        """Read an environment variable, treating missing or blank values as the default"""
+        value = os.environ.get(key, '').strip()
+        return cast(value) if value else default
+    
+    def open_alert_history(self) -> sqlite3.Connection:
+        """Open (and create if needed) the alert history database"""
+        conn = sqlite3.connect(self.alert_history_file)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS alerts (
+                day TEXT NOT NULL,
+                type TEXT NOT NULL,
+                sent_at TEXT NOT NULL,
+                payload_hash BLOB,
+                sent_epoch REAL,
+                PRIMARY KEY (day, type)
+            )
+        """)
+        # Databases created before the dedup window existed lack the last two columns
+        existing = {row[1] for row in conn.execute("PRAGMA table_info(alerts)")}
+        for column, column_type in (('payload_hash', 'BLOB'), ('sent_epoch', 'REAL')):
+            if column not in existing:
+                conn.execute(f"ALTER TABLE alerts ADD COLUMN {column} {column_type}")
+        conn.execute("CREATE INDEX IF NOT EXISTS alerts_payload ON alerts (payload_hash, sent_epoch)")
+        conn.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)")
+        conn.commit()
+        return conn
+    
+    def _load_setting(self, key: str) -> Optional[str]:
+        """Read a persisted setting from the alert history database"""
+        row = self._history_db.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
     
-    def save_alert_history(self):
-        """Save alert history to file"""
+    def _save_setting(self, key: str, value: str):
+        """Persist a setting in the alert history database (the workflow caches it between runs)"""
         try:
-            with open(self.alert_history_file, 'w') as f:
-                json.dump(self.alert_history, f, indent=2)
-        except Exception as e:
-            logger.error(f"Could not save alert history: {e}")
+            with self._history_db:
+                self._history_db.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
+        except sqlite3.Error as e:
+            logger.warning(f"Could not save setting {key}: {e}")
+    
+    @staticmethod
+    def _conn():
+        """Return a Snowflake connection for the alert query (get_latest_data closes it)"""
+        return get_conn(session_parameters={'QUERY_TAG': 'stock_alert'})
     
     def get_latest_data(self) -> Optional[Dict]:
         """Fetch latest stock data from Snowflake"""
         try:
-            conn = snowflake.connector.connect(
-                user=os.environ['SNOWFLAKE_USER'],
-                password=os.environ['SNOWFLAKE_PASSWORD'],
-                account=os.environ['SNOWFLAKE_ACCOUNT'],
-                warehouse=os.environ.get('SNOWFLAKE_WAREHOUSE', 'COMPUTE_WH'),
-                database=os.environ.get('SNOWFLAKE_DATABASE', 'WALMART_STOCK_DB'),
-                schema=os.environ.get('SNOWFLAKE_SCHEMA', 'PUBLIC')
-            )
-            cursor = conn.cursor()
-            
             # Get latest data with comparison to previous day
+            # (only the columns check_alerts and the email actually read,
+            # aliased to the lowercase keys they are looked up by)
             query = """
-                WITH latest_data AS (
-                    SELECT 
-                        DATE,
-                        OPEN,
-                        HIGH,
-                        LOW,
-                        CLOSE,
-                        VOLUME,
-                        CURRENT_PRICE,
-                        PRICE_CHANGE,
-                        PRICE_CHANGE_PCT,
-                        MA50,
-                        MA200,
-                        RSI_14,
-                        FIFTY_TWO_WEEK_HIGH,
-                        FIFTY_TWO_WEEK_LOW,
-                        VOLUME_MA_20,
-                        VOLUME_RATIO,
-                        PCT_FROM_52W_HIGH,
-                        PCT_FROM_52W_LOW,
-                        MARKET_CAP_BILLIONS,
-                        MARKET_STATUS,
-                        LAST_UPDATE_TIME
-                    FROM WALMART_STOCK_DATA
-                    ORDER BY DATE DESC
-                    LIMIT 2
-                )
-                SELECT * FROM latest_data ORDER BY DATE DESC
+                SELECT 
+                    DATE AS "date",
+                    OPEN AS "open",
+                    CLOSE AS "close",
+                    VOLUME AS "volume",
+                    CURRENT_PRICE AS "current_price",
+                    PRICE_CHANGE AS "price_change",
+                    PRICE_CHANGE_PCT AS "price_change_pct",
+                    MA50 AS "ma50",
+                    MA200 AS "ma200",
+                    RSI_14 AS "rsi_14",
+                    FIFTY_TWO_WEEK_HIGH AS "fifty_two_week_high",
+                    FIFTY_TWO_WEEK_LOW AS "fifty_two_week_low",
+                    VOLUME_RATIO AS "volume_ratio",
+                    PCT_FROM_52W_HIGH AS "pct_from_52w_high",
+                    PCT_FROM_52W_LOW AS "pct_from_52w_low"
+                FROM WALMART_STOCK_DATA
+                ORDER BY DATE DESC
+                LIMIT 2
             """
             
-            cursor.execute(query)
-            results = cursor.fetchall()
-            columns = [desc[0].lower() for desc in cursor.description]
-            
-            cursor.close()
-            conn.close()
+            # Arrow result batches are decoded natively; to_pylist() keeps SQL NULLs as None
+            conn = self._conn()
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute(query)
+                    table = cursor.fetch_arrow_all()
+            finally:
+                # One query per run, so don't leave a heartbeating session open until exit
+                conn.close()
+            results = table.to_pylist() if table is not None else []
             
             if results:
-                # Convert to dictionary
-                latest = dict(zip(columns, results[0]))
-                previous = dict(zip(columns, results[1])) if len(results) > 1 else None
-                
                 return {
-                    'current': latest,
-                    'previous': previous
+                    'current': results[0],
+                    'previous': results[1] if len(results) > 1 else None
                 }
             
             return None
@@ -149,92 +317,124 @@ class StockAlertSystem:
             logger.error(f"Error fetching data from Snowflake: {e}")
             return None
     
+    def alert_masks(self, current: np.recarray, previous: np.recarray) -> Tuple[Dict[str, np.ndarray], np.ndarray]:
+        """
+        Evaluate every alert rule over aligned current/previous record arrays
+        (one element per symbol). Returns boolean masks keyed by alert type
+        plus the opening gap percentages.
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            price = current['current_price']
+            ma50, ma200 = current['ma50'], current['ma200']
+            rsi = current['rsi_14']
+            
+            oversold = rsi <= self.rsi_oversold
+            golden = (previous['ma50'] <= previous['ma200']) & (ma50 > ma200)
+            near_high = current['pct_from_52w_high'] >= -1
+            gap_pct = (current['open'] - previous['close']) / previous['close'] * 100
+            
+            masks = {
+                'PRICE_MOVEMENT': np.abs(current['price_change_pct']) >= self.price_change_threshold,
+                'VOLUME_SPIKE': current['volume_ratio'] >= self.volume_spike_threshold,
+                'RSI_OVERSOLD': oversold,
+                'RSI_OVERBOUGHT': ~oversold & (rsi >= self.rsi_overbought),
+                'GOLDEN_CROSS': golden,
+                'DEATH_CROSS': ~golden & (previous['ma50'] >= previous['ma200']) & (ma50 < ma200),
+                'BREAKOUT': (price > ma50) & (price > ma200) & (previous['current_price'] <= previous['ma200']),
+                '52W_HIGH': near_high,
+                '52W_LOW': ~near_high & (current['pct_from_52w_low'] <= 5),
+                'GAP': np.abs(gap_pct) >= 1,  # 1% gap threshold
+            }
+        return masks, gap_pct
+    
     def check_alerts(self, data: Dict) -> List[Dict]:
         """Check for various alert conditions"""
         alerts = []
         current = data['current']
         previous = data['previous'] if data.get('previous') else None
         
+        masks, gap_pcts = self.alert_masks(_alert_records([current]), _alert_records([previous]))
+        hit = {alert_type: bool(mask[0]) for alert_type, mask in masks.items()}
+        if not any(hit.values()):
+            return alerts
+        
+        # Fields used by the alert messages below
+        pcp = current.get('price_change_pct')
+        vr = current.get('volume_ratio')
+        rsi = current.get('rsi_14')
+        cp = current.get('current_price')
+        
         # 1. Large Price Movement Alert
-        if current.get('price_change_pct') and abs(current['price_change_pct']) >= self.price_change_threshold:
-            direction = 'up' if current['price_change_pct'] > 0 else 'down'
+        if hit['PRICE_MOVEMENT']:
+            direction = 'up' if pcp > 0 else 'down'
             alerts.append({
                 'type': 'PRICE_MOVEMENT',
                 'severity': 'HIGH',
-                'title': f'🚨 Large Price Movement: {direction.upper()} {abs(current["price_change_pct"]):.2f}%',
-                'message': f'WMT is {direction} ${abs(current["price_change"]):.2f} ({current["price_change_pct"]:+.2f}%) to ${current["current_price"]:.2f}'
+                'title': f'🚨 Large Price Movement: {direction.upper()} {abs(pcp):.2f}%',
+                'message': f'WMT is {direction} ${abs(current["price_change"]):.2f} ({pcp:+.2f}%) to ${cp:.2f}'
             })
         
         # 2. Volume Spike Alert
-        if current.get('volume_ratio') and current['volume_ratio'] >= self.volume_spike_threshold:
+        if hit['VOLUME_SPIKE']:
             alerts.append({
                 'type': 'VOLUME_SPIKE',
                 'severity': 'MEDIUM',
-                'title': f'📊 Unusual Volume: {current["volume_ratio"]:.2f}x Average',
-                'message': f'Trading volume is {current["volume_ratio"]:.2f}x the 20-day average ({current["volume"]:,} shares)'
+                'title': f'📊 Unusual Volume: {vr:.2f}x Average',
+                'message': f'Trading volume is {vr:.2f}x the 20-day average ({current["volume"]:,} shares)'
             })
         
         # 3. RSI Alerts
-        if current.get('rsi_14'):
-            if current['rsi_14'] <= self.rsi_oversold:
-                alerts.append({
-                    'type': 'RSI_OVERSOLD',
-                    'severity': 'HIGH',
-                    'title': f'🟢 RSI Oversold Signal: {current["rsi_14"]:.2f}',
-                    'message': f'RSI(14) is {current["rsi_14"]:.2f}, indicating potential buying opportunity'
-                })
-            elif current['rsi_14'] >= self.rsi_overbought:
-                alerts.append({
-                    'type': 'RSI_OVERBOUGHT',
-                    'severity': 'MEDIUM',
-                    'title': f'🔴 RSI Overbought Signal: {current["rsi_14"]:.2f}',
-                    'message': f'RSI(14) is {current["rsi_14"]:.2f}, indicating potential selling pressure'
-                })
+        if hit['RSI_OVERSOLD']:
+            alerts.append({
+                'type': 'RSI_OVERSOLD',
+                'severity': 'HIGH',
+                'title': f'🟢 RSI Oversold Signal: {rsi:.2f}',
+                'message': f'RSI(14) is {rsi:.2f}, indicating potential buying opportunity'
+            })
+        elif hit['RSI_OVERBOUGHT']:
+            alerts.append({
+                'type': 'RSI_OVERBOUGHT',
+                'severity': 'MEDIUM',
+                'title': f'🔴 RSI Overbought Signal: {rsi:.2f}',
+                'message': f'RSI(14) is {rsi:.2f}, indicating potential selling pressure'
+            })
         
         # 4. Moving Average Crossover Alerts
-        if current.get('ma50') and current.get('ma200'):
-            current_price = current['current_price']
-            
-            # Golden Cross (50-day crosses above 200-day)
-            if previous and previous.get('ma50') and previous.get('ma200'):
-                if (previous['ma50'] <= previous['ma200'] and 
-                    current['ma50'] > current['ma200']):
-                    alerts.append({
-                        'type': 'GOLDEN_CROSS',
-                        'severity': 'HIGH',
-                        'title': '🌟 Golden Cross Signal',
-                        'message': 'MA50 crossed above MA200 - Bullish signal'
-                    })
-                # Death Cross (50-day crosses below 200-day)
-                elif (previous['ma50'] >= previous['ma200'] and 
-                      current['ma50'] < current['ma200']):
-                    alerts.append({
-                        'type': 'DEATH_CROSS',
-                        'severity': 'HIGH',
-                        'title': '💀 Death Cross Signal',
-                        'message': 'MA50 crossed below MA200 - Bearish signal'
-                    })
-            
-            # Price vs Moving Averages
-            if current_price > current['ma50'] and current_price > current['ma200']:
-                if previous and previous.get('current_price') and previous.get('ma200'):
-                    if previous['current_price'] <= previous['ma200']:
-                        alerts.append({
-                            'type': 'BREAKOUT',
-                            'severity': 'MEDIUM',
-                            'title': '📈 Breakout Above MA200',
-                            'message': f'Price (${current_price:.2f}) broke above MA200 (${current["ma200"]:.2f})'
-                        })
+        # Golden Cross (50-day crosses above 200-day)
+        if hit['GOLDEN_CROSS']:
+            alerts.append({
+                'type': 'GOLDEN_CROSS',
+                'severity': 'HIGH',
+                'title': '🌟 Golden Cross Signal',
+                'message': 'MA50 crossed above MA200 - Bullish signal'
+            })
+        # Death Cross (50-day crosses below 200-day)
+        elif hit['DEATH_CROSS']:
+            alerts.append({
+                'type': 'DEATH_CROSS',
+                'severity': 'HIGH',
+                'title': '💀 Death Cross Signal',
+                'message': 'MA50 crossed below MA200 - Bearish signal'
+            })
+        
+        # Price vs Moving Averages
+        if hit['BREAKOUT']:
+            alerts.append({
+                'type': 'BREAKOUT',
+                'severity': 'MEDIUM',
+                'title': '📈 Breakout Above MA200',
+                'message': f'Price (${cp:.2f}) broke above MA200 (${current["ma200"]:.2f})'
+            })
         
         # 5. 52-Week High/Low Alerts
-        if current.get('pct_from_52w_high') and current['pct_from_52w_high'] >= -1:
+        if hit['52W_HIGH']:
             alerts.append({
                 'type': '52W_HIGH',
                 'severity': 'HIGH',
                 'title': '🎯 Near 52-Week High',
                 'message': f'Price is within 1% of 52-week high (${current.get("fifty_two_week_high", 0):.2f})'
             })
-        elif current.get('pct_from_52w_low') and current['pct_from_52w_low'] <= 5:
+        elif hit['52W_LOW']:
             alerts.append({
                 'type': '52W_LOW',
                 'severity': 'HIGH',
@@ -243,44 +443,65 @@ class StockAlertSystem:
             })
         
         # 6. Gap Up/Down Alert
-        if previous and current.get('open') and previous.get('close'):
-            gap_pct = ((current['open'] - previous['close']) / previous['close']) * 100
-            if abs(gap_pct) >= 1:  # 1% gap threshold
-                gap_type = 'up' if gap_pct > 0 else 'down'
-                alerts.append({
-                    'type': f'GAP_{gap_type.upper()}',
-                    'severity': 'MEDIUM',
-                    'title': f'📍 Gap {gap_type.capitalize()}: {abs(gap_pct):.2f}%',
-                    'message': f'Stock opened with a {abs(gap_pct):.2f}% gap {gap_type} from previous close'
-                })
+        if hit['GAP']:
+            gap_pct = float(gap_pcts[0])
+            gap_type = 'up' if gap_pct > 0 else 'down'
+            alerts.append({
+                'type': f'GAP_{gap_type.upper()}',
+                'severity': 'MEDIUM',
+                'title': f'📍 Gap {gap_type.capitalize()}: {abs(gap_pct):.2f}%',
+                'message': f'Stock opened with a {abs(gap_pct):.2f}% gap {gap_type} from previous close'
+            })
         
         return alerts
     
-    def should_send_alert(self, alert: Dict) -> bool:
-        """Check if alert should be sent (avoid duplicates)"""
-        today = datetime.now().strftime('%Y-%m-%d')
-        alert_key = f"{today}_{alert['type']}"
+    def should_send_alert(self, alert: Dict, pending: int = 0) -> bool:
+        """Check if alert should be sent (avoid duplicates); pending counts alerts
+        already accepted for the current batch but not yet recorded as sent"""
         
         # Check if this alert was already sent today
-        if alert_key in self.alert_history:
-            last_sent = datetime.fromisoformat(self.alert_history[alert_key])
+        row = self._history_db.execute(
+            "SELECT sent_at FROM alerts WHERE day = ? AND type = ?",
+            (self._today, alert['type'])
+        ).fetchone()
+        if row:
+            last_sent = datetime.fromisoformat(row[0])
             # Don't send same alert type more than once per day
-            if (datetime.now() - last_sent).total_seconds() < 86400:
+            if (self._now - last_sent).total_seconds() < 86400:
                 return False
         
+        # Suppress an identical message sent within the dedup window, even across
+        # midnight or under a different alert type
+        since = self._now.timestamp() - self.dedup_window_seconds
+        if self._history_db.execute(
+            "SELECT 1 FROM alerts WHERE payload_hash = ? AND sent_epoch >= ? LIMIT 1",
+            (self._payload_hash(alert), since)
+        ).fetchone():
+            return False
+        
+        # Global rate limit on alerts per minute, including this batch
+        sent_last_minute = self._history_db.execute(
+            "SELECT COUNT(*) FROM alerts WHERE sent_epoch >= ?",
+            (self._now.timestamp() - 60,)
+        ).fetchone()[0]
+        if sent_last_minute + pending >= self.rate_limit_per_min:
+            logger.warning(f"Rate limit reached ({self.rate_limit_per_min}/min), holding back {alert['type']}")
+            return False
+        
         return True
     
+    @staticmethod
+    def _payload_hash(alert: Dict) -> bytes:
+        """Fingerprint an alert by its message text"""
+        return hashlib.md5(alert['message'].encode('utf-8')).digest()
+    
     def format_email_html(self, alerts: List[Dict], data: Dict) -> str:
         """Format alerts as HTML email"""
         current = data['current']
         
         # Get Central Time
-        central = pytz.timezone('US/Central')
-        now_central = datetime.now(central)
-        
-        # Group alerts by severity
-        high_alerts = [a for a in alerts if a['severity'] == 'HIGH']
-        medium_alerts = [a for a in alerts if a['severity'] == 'MEDIUM']
+        central = ZoneInfo('America/Chicago')
+        now_central = self._now.astimezone(central)
         
         # Handle None values with defaults
         current_price = current.get('current_price', 0)
@@ -288,158 +509,41 @@ class StockAlertSystem:
         price_change_pct = current.get('price_change_pct', 0)
         volume = current.get('volume', 0)
         
-        html = f"""
-        <html>
-        <head>
-            <style>
-                body {{ font-family: Arial, sans-serif; background-color: #f4f4f4; padding: 20px; }}
-                .container {{ background-color: white; border-radius: 10px; padding: 20px; max-width: 600px; margin: 0 auto; }}
-                .header {{ background: linear-gradient(135deg, #0071ce 0%, #005a9c 100%); color: white; padding: 20px; border-radius: 10px 10px 0 0; margin: -20px -20px 20px -20px; }}
-                .walmart-logo {{ font-size: 24px; font-weight: bold; color: white; }}
-                .price-info {{ background-color: #f8f9fa; padding: 15px; border-radius: 8px; margin: 20px 0; }}
-                .alert-high {{ border-left: 4px solid #dc3545; padding: 10px; margin: 10px 0; background-color: #fff5f5; }}
-                .alert-medium {{ border-left: 4px solid #ffc107; padding: 10px; margin: 10px 0; background-color: #fffdf5; }}
-                .metric {{ display: inline-block; margin: 10px 20px 10px 0; }}
-                .metric-label {{ color: #666; font-size: 12px; }}
-                .metric-value {{ font-size: 18px; font-weight: bold; color: #333; }}
-                .footer {{ margin-top: 30px; padding-top: 20px; border-top: 1px solid #ddd; font-size: 12px; color: #666; }}
-                .button {{ background-color: #0071ce; color: white; padding: 10px 20px; text-decoration: none; border-radius: 5px; display: inline-block; margin: 10px 0; }}
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <div class="header">
-                    <div style="display: flex; align-items: center; gap: 15px;">
-                        <svg width="50" height="50" viewBox="0 0 50 50" style="flex-shrink: 0;">
-                            <circle cx="25" cy="25" r="25" fill="#FFC220"/>
-                            <g transform="translate(25, 25)">
-                                <!-- Walmart spark/star pattern -->
-                                <rect x="-3" y="-12" width="6" height="8" rx="3" fill="#0071CE"/>
-                                <rect x="-3" y="4" width="6" height="8" rx="3" fill="#0071CE"/>
-                                <rect x="-12" y="-3" width="8" height="6" rx="3" fill="#0071CE" transform="rotate(90 0 0)"/>
-                                <rect x="4" y="-3" width="8" height="6" rx="3" fill="#0071CE" transform="rotate(90 0 0)"/>
-                                <rect x="-10" y="-10" width="8" height="6" rx="3" fill="#0071CE" transform="rotate(45 0 0)"/>
-                                <rect x="4" y="4" width="8" height="6" rx="3" fill="#0071CE" transform="rotate(45 0 0)"/>
-                                <rect x="-10" y="4" width="8" height="6" rx="3" fill="#0071CE" transform="rotate(-45 0 0)"/>
-                                <rect x="4" y="-10" width="8" height="6" rx="3" fill="#0071CE" transform="rotate(-45 0 0)"/>
-                            </g>
-                        </svg>
-                        <div>
-                            <div class="walmart-logo">Walmart Stock Alerts</div>
-                            <div style="font-size: 12px; opacity: 0.9; margin-top: 2px;">NYSE: WMT</div>
-                        </div>
-                    </div>
-                    <div style="font-size: 14px; margin-top: 15px; padding-top: 15px; border-top: 1px solid rgba(255,255,255,0.2);">
-                        <div style="font-weight: bold;">{now_central.strftime('%A, %B %d, %Y at %I:%M %p')}</div>
-                        <div style="font-size: 12px; opacity: 0.9; margin-top: 3px;">Central {'Daylight' if now_central.dst() else 'Standard'} Time (C{'D' if now_central.dst() else 'S'}T) • Bentonville, AR</div>
-                    </div>
-                </div>
-                
-                <div class="price-info">
-                    <div class="metric">
-                        <div class="metric-label">Current Price</div>
-                        <div class="metric-value">${current_price:.2f}</div>
-                    </div>
-                    <div class="metric">
-                        <div class="metric-label">Change</div>
-                        <div class="metric-value" style="color: {'green' if price_change >= 0 else 'red'};">
-                            {price_change:+.2f} ({price_change_pct:+.2f}%)
-                        </div>
-                    </div>
-                    <div class="metric">
-                        <div class="metric-label">Volume</div>
-                        <div class="metric-value">{volume:,.0f}</div>
-                    </div>
-                </div>
-        """
-        
-        if high_alerts:
-            html += "<h3>🚨 High Priority Alerts</h3>"
-            for alert in high_alerts:
-                html += f"""
-                <div class="alert-high">
-                    <strong>{alert['title']}</strong><br>
-                    {alert['message']}
-                </div>
-                """
-        
-        if medium_alerts:
-            html += "<h3>⚠️ Medium Priority Alerts</h3>"
-            for alert in medium_alerts:
-                html += f"""
-                <div class="alert-medium">
-                    <strong>{alert['title']}</strong><br>
-                    {alert['message']}
-                </div>
-                """
+        # Alerts grouped by severity, rendered in one pass
+        alert_html = []
+        for severity, css_class, heading in _ALERT_SECTIONS:
+            group = [a for a in alerts if a['severity'] == severity]
+            if group:
+                alert_html.append(f"<h3>{heading}</h3>")
+                alert_html.extend(
+                    f'<div class="{css_class}"><strong>{a["title"]}</strong><br>{a["message"]}</div>'
+                    for a in group
+                )
         
         # Add key metrics with None handling
         ma50_display = f"${current.get('ma50', 0):.2f}" if current.get('ma50') else 'N/A'
         ma200_display = f"${current.get('ma200', 0):.2f}" if current.get('ma200') else 'N/A'
         
-        html += f"""
-                <h3>📊 Key Metrics</h3>
-                <table style="width: 100%; border-collapse: collapse;">
-                    <tr>
-                        <td style="padding: 8px; border-bottom: 1px solid #ddd;">
-                            <strong>RSI (14)</strong>
-                        </td>
-                        <td style="padding: 8px; border-bottom: 1px solid #ddd; text-align: right;">
-                            {current.get('rsi_14', 'N/A')}
-                        </td>
-                    </tr>
-                    <tr>
-                        <td style="padding: 8px; border-bottom: 1px solid #ddd;">
-                            <strong>MA50</strong>
-                        </td>
-                        <td style="padding: 8px; border-bottom: 1px solid #ddd; text-align: right;">
-                            {ma50_display}
-                        </td>
-                    </tr>
-                    <tr>
-                        <td style="padding: 8px; border-bottom: 1px solid #ddd;">
-                            <strong>MA200</strong>
-                        </td>
-                        <td style="padding: 8px; border-bottom: 1px solid #ddd; text-align: right;">
-                            {ma200_display}
-                        </td>
-                    </tr>
-                    <tr>
-                        <td style="padding: 8px; border-bottom: 1px solid #ddd;">
-                            <strong>52-Week Range</strong>
-                        </td>
-                        <td style="padding: 8px; border-bottom: 1px solid #ddd; text-align: right;">
-                            ${current.get('fifty_two_week_low', 0):.2f} - ${current.get('fifty_two_week_high', 0):.2f}
-                        </td>
-                    </tr>
-                    <tr>
-                        <td style="padding: 8px;">
-                            <strong>Volume Ratio</strong>
-                        </td>
-                        <td style="padding: 8px; text-align: right;">
-                            {current.get('volume_ratio', 0):.2f}x
-                        </td>
-                    </tr>
-                </table>
-                
-                <div style="text-align: center; margin-top: 30px;">
-                    <a href="https://finance.yahoo.com/quote/WMT" class="button">View on Yahoo Finance</a>
-                </div>
-                
-                <div class="footer">
-                    <p>This is an automated alert from your Walmart Stock Monitoring System.</p>
-                    <p>Alert thresholds: Price change ≥{self.price_change_threshold}% | Volume ≥{self.volume_spike_threshold}x | RSI ≤{self.rsi_oversold} or ≥{self.rsi_overbought}</p>
-                    <p>To modify alert settings, update the environment variables in your configuration.</p>
-                </div>
-            </div>
-        </body>
-        </html>
-        """
-        
-        return html
+        return _HTML_TEMPLATE.substitute(
+            timestamp=now_central.strftime('%A, %B %d, %Y at %I:%M %p'),
+            dst_name='Daylight' if now_central.dst() else 'Standard',
+            dst_letter='D' if now_central.dst() else 'S',
+            current_price=f"${current_price:.2f}",
+            change_color='green' if price_change >= 0 else 'red',
+            change=f"{price_change:+.2f} ({price_change_pct:+.2f}%)",
+            volume=f"{volume:,.0f}",
+            alerts="\n".join(alert_html),
+            rsi=current.get('rsi_14', 'N/A'),
+            ma50=ma50_display,
+            ma200=ma200_display,
+            range_52w=f"${current.get('fifty_two_week_low', 0):.2f} - ${current.get('fifty_two_week_high', 0):.2f}",
+            volume_ratio=f"{current.get('volume_ratio', 0):.2f}x",
+            thresholds=(f"Price change ≥{self.price_change_threshold}% | Volume ≥{self.volume_spike_threshold}x | "
+                        f"RSI ≤{self.rsi_oversold} or ≥{self.rsi_overbought}"),
+        )
     
-    def send_email(self, alerts: List[Dict], data: Dict):
-        """Send email with alerts"""
+    def _validate_config(self) -> bool:
+        """Check the email settings before any Snowflake work is done"""
         if not self.sender_email:
             logger.error(f"Sender email is missing!")
             return False
@@ -452,9 +556,13 @@ class StockAlertSystem:
             logger.error(f"Sender password is missing!")
             return False
         
+        return True
+    
+    def send_email(self, alerts: List[Dict], data: Dict) -> bool:
+        """Build the alert email and send it"""
         try:
             # Create message
-            msg = MIMEMultipart('alternative')
+            msg = EmailMessage()
             msg['Subject'] = f"WMT Stock Alert: {alerts[0]['title']}"
             msg['From'] = self.sender_email
             msg['To'] = ', '.join(self.recipient_emails)
@@ -465,7 +573,7 @@ class StockAlertSystem:
             # Also create plain text version
             text_content = f"""
             WALMART STOCK ALERTS
-            {datetime.now().strftime('%B %d, %Y at %I:%M %p')}
+            {self._now.strftime('%B %d, %Y at %I:%M %p')}
             
             Current Price: ${data['current'].get('current_price', 0):.2f}
             Change: {data['current'].get('price_change', 0):+.2f} ({data['current'].get('price_change_pct', 0):+.2f}%)
@@ -475,49 +583,107 @@ class StockAlertSystem:
             for alert in alerts:
                 text_content += f"\n{alert['title']}\n{alert['message']}\n"
             
-            # Attach parts
-            part1 = MIMEText(text_content, 'plain')
-            part2 = MIMEText(html_content, 'html')
-            msg.attach(part1)
-            msg.attach(part2)
-            
-            # Send email with detailed logging and error handling
-            logger.info(f"Attempting to connect to {self.smtp_server}:{self.smtp_port}")
-            
-            # Try different connection methods
+            # Plain text body with the HTML version as its alternative
+            msg.set_content(text_content)
+            msg.add_alternative(html_content, subtype='html')
+        except Exception as e:
+            logger.error(f"❌ Failed to build email: {e}")
+            logger.error(traceback.format_exc())
+            return False
+        
+        return self._do_send(msg, alerts)
+    
+    def _get_smtp(self) -> smtplib.SMTP:
+        """Return a live, logged-in SMTP client, reconnecting only if the cached one is dead"""
+        if self._smtp is not None:
             try:
-                # Method 1: Standard connection
-                server = smtplib.SMTP(self.smtp_server, self.smtp_port)
-                server.set_debuglevel(0)  # Set to 1 for debug output
-                server.ehlo()
-                server.starttls()
-                server.ehlo()
-            except Exception as e:
-                logger.warning(f"Standard connection failed: {e}, trying alternative...")
-                # Method 2: Direct SSL connection
-                try:
-                    import ssl
-                    context = ssl.create_default_context()
-                    server = smtplib.SMTP(self.smtp_server, self.smtp_port)
-                    server.starttls(context=context)
-                except Exception as e2:
-                    logger.error(f"Alternative connection also failed: {e2}")
-                    raise
-            
-            logger.info(f"Connected to SMTP server, attempting login...")
+                if self._smtp.noop()[0] == 250:
+                    return self._smtp
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._close_smtp()
+        
+        logger.info(f"Attempting to connect to {self.smtp_server}:{self.smtp_port}")
+        
+        # Start with the connection method that worked last time; fall back to the other
+        fallback = 'starttls' if self._smtp_mode == 'ssl' else 'ssl'
+        try:
+            server = self._connect_smtp(self._smtp_mode)
+        except Exception as e:
+            logger.warning(f"{self._smtp_mode} connection failed: {e}, trying {fallback}...")
+            try:
+                server = self._connect_smtp(fallback)
+            except Exception as e2:
+                logger.error(f"Alternative connection also failed: {e2}")
+                raise
+            self._smtp_mode = fallback
+            self._save_setting(self._smtp_mode_key, fallback)
+        
+        logger.info(f"Connected to SMTP server, attempting login...")
+        try:
             server.login(self.sender_email, self.sender_password)
-            logger.info(f"Login successful, sending email...")
-            
-            server.send_message(msg)
+        except Exception:
+            server.close()
+            raise
+        logger.info(f"Login successful")
+        
+        self._smtp = server
+        return server
+    
+    def _connect_smtp(self, mode: str) -> smtplib.SMTP:
+        """Open an encrypted SMTP session using implicit SSL or STARTTLS"""
+        context = ssl.create_default_context()
+        if mode == 'ssl':
+            return smtplib.SMTP_SSL(self.smtp_server, self.smtp_port, timeout=self.smtp_timeout, context=context)
+        
+        server = smtplib.SMTP(self.smtp_server, self.smtp_port, timeout=self.smtp_timeout)
+        server.set_debuglevel(0)  # Set to 1 for debug output
+        server.ehlo()
+        server.starttls(context=context)
+        server.ehlo()
+        return server
+    
+    def _close_smtp(self):
+        """Politely close the cached SMTP client, if any"""
+        server, self._smtp = self._smtp, None
+        if server is None:
+            return
+        try:
             server.quit()
+        except (smtplib.SMTPException, OSError):
+            server.close()
+    
+    def _do_send(self, msg: EmailMessage, alerts: List[Dict]) -> bool:
+        """Deliver a prepared message over SMTP and record the sent alerts"""
+        try:
+            # Connect failures propagate from _get_smtp; only a send on a reused session is retried
+            cached = self._smtp
+            server = self._get_smtp()
+            try:
+                server.send_message(msg)
+            except (socket.timeout, smtplib.SMTPServerDisconnected) as e:
+                if server is not cached:
+                    raise
+                # Cached session went stale between NOOP and send - reconnect once
+                logger.warning(f"SMTP session dropped ({e}), reconnecting...")
+                self._close_smtp()
+                self._get_smtp().send_message(msg)
             
             logger.info(f"✅ Email sent successfully to {', '.join(self.recipient_emails)}")
             
-            # Update alert history
-            for alert in alerts:
-                alert_key = f"{datetime.now().strftime('%Y-%m-%d')}_{alert['type']}"
-                self.alert_history[alert_key] = datetime.now().isoformat()
-            self.save_alert_history()
+            # Update alert history - one transaction, so a crash mid-batch rolls back
+            # cleanly instead of leaving a partially recorded batch behind
+            sent_at, sent_epoch = self._now.isoformat(), self._now.timestamp()
+            try:
+                with self._history_db:
+                    self._history_db.executemany(
+                        "INSERT OR REPLACE INTO alerts (day, type, sent_at, payload_hash, sent_epoch) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        [(self._today, alert['type'], sent_at, self._payload_hash(alert), sent_epoch)
+                         for alert in alerts]
+                    )
+            except sqlite3.Error as e:
+                logger.error(f"Could not save alert history: {e}")
             
             return True
             
@@ -528,6 +694,11 @@ class StockAlertSystem:
             logger.error("2. Your app password in SENDER_PASSWORD secret")
             logger.error("3. That 2-factor auth is enabled on your Gmail")
             return False
+        except (socket.timeout, smtplib.SMTPServerDisconnected) as e:
+            # Give up after the single reconnect above rather than retrying indefinitely
+            logger.error(f"❌ SMTP server timed out or disconnected (timeout {self.smtp_timeout}s): {e}")
+            self._close_smtp()
+            return False
         except smtplib.SMTPException as e:
             logger.error(f"❌ SMTP error: {e}")
             return False
@@ -543,6 +714,13 @@ class StockAlertSystem:
         logger.info("WALMART STOCK ALERT SYSTEM")
         logger.info("="*60)
         
+        self._now = datetime.now()
+        self._today = self._now.strftime('%Y-%m-%d')
+        
+        # No point querying Snowflake if alerts could never be delivered
+        if not self._validate_config():
+            return False
+        
         # Fetch latest data
         data = self.get_latest_data()
         if not data:
@@ -561,7 +739,10 @@ class StockAlertSystem:
             return True
         
         # Filter alerts that should be sent
-        alerts_to_send = [a for a in alerts if self.should_send_alert(a)]
+        alerts_to_send = []
+        for alert in alerts:
+            if self.should_send_alert(alert, pending=len(alerts_to_send)):
+                alerts_to_send.append(alert)
         
         if not alerts_to_send:
             logger.info(f"Found {len(alerts)} alerts but all were recently sent")
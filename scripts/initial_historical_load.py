@@ -6,13 +6,20 @@ Run this ONCE to populate your database with historical data from 1972 to presen
 """
 
 import yfinance as yf
-import snowflake.connector
+from snowflake_conn import get_conn
 import pandas as pd
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 from datetime import datetime
 import logging
 import os
 import sys
 
+# pandas_tools imports fine without pyarrow and write_pandas only fails when called,
+# so check the connector's own flag for the [pandas] extra instead
+from snowflake.connector.options import installed_pandas
+from snowflake.connector.pandas_tools import write_pandas
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -20,6 +27,56 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Session-scoped table the history is bulk loaded into before it is merged
+STAGING_TABLE = "WALMART_STOCK_DATA_STAGING"
+
+# Upsert the staged history on DATE; an existing row is only rewritten when its
+# prices, volume or averages changed (e.g. after Yahoo re-adjusts for a dividend)
+MERGE_SQL = f"""
+    MERGE INTO WALMART_STOCK_DATA t
+    USING {STAGING_TABLE} s
+    ON t.DATE = s.DATE
+    WHEN MATCHED AND (
+        t.OPEN IS DISTINCT FROM s.OPEN OR t.HIGH IS DISTINCT FROM s.HIGH
+        OR t.LOW IS DISTINCT FROM s.LOW OR t.CLOSE IS DISTINCT FROM s.CLOSE
+        OR t.VOLUME IS DISTINCT FROM s.VOLUME
+        OR t.MA50 IS DISTINCT FROM s.MA50 OR t.MA200 IS DISTINCT FROM s.MA200
+    ) THEN UPDATE SET
+        OPEN = s.OPEN,
+        HIGH = s.HIGH,
+        LOW = s.LOW,
+        CLOSE = s.CLOSE,
+        VOLUME = s.VOLUME,
+        MA50 = s.MA50,
+        MA200 = s.MA200,
+        CURRENT_PRICE = s.CURRENT_PRICE,
+        UPDATE_COUNT = s.UPDATE_COUNT,
+        IS_LIVE_DATA = s.IS_LIVE_DATA,
+        PREVIOUS_CLOSE = s.PREVIOUS_CLOSE,
+        PRICE_CHANGE = s.PRICE_CHANGE,
+        PRICE_CHANGE_PCT = s.PRICE_CHANGE_PCT,
+        INTRADAY_HIGH = s.INTRADAY_HIGH,
+        INTRADAY_LOW = s.INTRADAY_LOW,
+        LAST_UPDATE_TIME = s.LAST_UPDATE_TIME
+    WHEN NOT MATCHED THEN INSERT
+        (DATE, OPEN, HIGH, LOW, CLOSE, VOLUME, MA50, MA200,
+         CURRENT_PRICE, UPDATE_COUNT, IS_LIVE_DATA, PREVIOUS_CLOSE,
+         PRICE_CHANGE, PRICE_CHANGE_PCT, INTRADAY_HIGH, INTRADAY_LOW,
+         LAST_UPDATE_TIME)
+    VALUES
+        (s.DATE, s.OPEN, s.HIGH, s.LOW, s.CLOSE, s.VOLUME, s.MA50, s.MA200,
+         s.CURRENT_PRICE, s.UPDATE_COUNT, s.IS_LIVE_DATA, s.PREVIOUS_CLOSE,
+         s.PRICE_CHANGE, s.PRICE_CHANGE_PCT, s.INTRADAY_HIGH, s.INTRADAY_LOW,
+         s.LAST_UPDATE_TIME)
+"""
+
+def moving_average(values, window):
+    """Trailing simple moving average; the first window-1 entries are NaN"""
+    ma = np.full_like(values, np.nan)
+    if len(values) >= window:
+        ma[window - 1:] = sliding_window_view(values, window).mean(axis=1)
+    return ma
+
 def extract_all_historical_data():
     """Extract ALL historical Walmart data from Yahoo Finance"""
     try:
@@ -28,10 +85,9 @@ def extract_all_historical_data():
         logger.info("="*60)
         
         logger.info("Fetching ALL Walmart historical data from Yahoo Finance...")
-        wmt = yf.Ticker("WMT")
-        
-        # Get maximum available history
-        hist = wmt.history(period="max")
+        # Get maximum available history in one bulk download (same split/dividend
+        # adjusted prices as Ticker.history, without the Ticker wrapper)
+        hist = yf.download("WMT", period="max", auto_adjust=True, progress=False, threads=True)
         
         if hist.empty:
             logger.error("No data received from Yahoo Finance")
@@ -40,53 +96,128 @@ def extract_all_historical_data():
         logger.info(f"✅ Downloaded {len(hist)} days of historical data")
         logger.info(f"Date range: {hist.index[0].date()} to {hist.index[-1].date()}")
         
-        # Reset index to get Date as column
+        # Reset index to get Date as column, then work on the Yahoo frame in place
+        # under the warehouse column names rather than copying into a new DataFrame
+        if isinstance(hist.columns, pd.MultiIndex):
+            # Newer yfinance versions key single-ticker downloads as (field, ticker)
+            hist.columns = hist.columns.get_level_values(0)
+        hist = hist.reindex(columns=['Open', 'High', 'Low', 'Close', 'Volume'])
         hist.reset_index(inplace=True)
-        
-        # Create dataframe with all required columns
-        df = pd.DataFrame()
+        hist.rename(columns={
+            'Date': 'DATE', 'Open': 'OPEN', 'High': 'HIGH',
+            'Low': 'LOW', 'Close': 'CLOSE', 'Volume': 'VOLUME'
+        }, inplace=True)
+        df = hist
         
         # Basic OHLCV data
-        df['DATE'] = pd.to_datetime(hist['Date']).dt.strftime('%Y-%m-%d')
-        df['OPEN'] = hist['Open'].round(2)
-        df['HIGH'] = hist['High'].round(2)
-        df['LOW'] = hist['Low'].round(2)
-        df['CLOSE'] = hist['Close'].round(2)
-        df['VOLUME'] = hist['Volume'].astype(int)
+        df['DATE'] = df['DATE'].dt.date  # native dates bind straight to the DATE column
+        close = np.round(df['CLOSE'].to_numpy(dtype=np.float64), 2)
+        high = np.round(df['HIGH'].to_numpy(dtype=np.float64), 2)
+        low = np.round(df['LOW'].to_numpy(dtype=np.float64), 2)
+        df['OPEN'] = np.round(df['OPEN'].to_numpy(dtype=np.float64), 2)
+        df['HIGH'] = high
+        df['LOW'] = low
+        # Narrowest integer type that holds the volumes (int32 unless a day ever tops 2^31);
+        # prices stay float64 so the stored values are exactly the rounded cents
+        df['VOLUME'] = pd.to_numeric(df['VOLUME'].astype(np.int64), downcast='integer')
         
-        # Calculate moving averages
-        logger.info("Calculating moving averages...")
-        df['MA50'] = hist['Close'].rolling(window=50).mean().round(2)
-        df['MA200'] = hist['Close'].rolling(window=200).mean().round(2)
+        # Calculate moving averages (from the unrounded closes)
+        logger.debug("Calculating moving averages...")
+        raw_close = df['CLOSE'].to_numpy(dtype=np.float64)
+        df['MA50'] = np.round(moving_average(raw_close, 50), 2)
+        df['MA200'] = np.round(moving_average(raw_close, 200), 2)
+        df['CLOSE'] = close
         
         # For historical data, set these to match daily values
-        df['CURRENT_PRICE'] = df['CLOSE']
-        df['UPDATE_COUNT'] = 0  # Historical data hasn't been updated
+        df['CURRENT_PRICE'] = close
+        df['UPDATE_COUNT'] = np.zeros(len(df), dtype=np.int8)  # Historical data hasn't been updated
         df['IS_LIVE_DATA'] = False  # This is historical, not live
         
         # Calculate previous close and changes
-        df['PREVIOUS_CLOSE'] = df['CLOSE'].shift(1)
-        df['PRICE_CHANGE'] = (df['CLOSE'] - df['PREVIOUS_CLOSE']).round(2)
-        df['PRICE_CHANGE_PCT'] = ((df['PRICE_CHANGE'] / df['PREVIOUS_CLOSE']) * 100).round(4)
+        # (the first row has no previous close; it gets 0 for all three, never NaN)
+        previous_close = np.empty_like(close)
+        previous_close[:1] = 0.0
+        previous_close[1:] = close[:-1]
+        df['PREVIOUS_CLOSE'] = previous_close
+        has_previous = previous_close != 0
+        price_change = np.round(np.where(has_previous, close - previous_close, 0.0), 2)
+        df['PRICE_CHANGE'] = price_change
+        df['PRICE_CHANGE_PCT'] = np.round(
+            np.divide(price_change, previous_close, out=np.zeros_like(price_change), where=has_previous) * 100, 4
+        )
         
         # Intraday values same as daily for historical
-        df['INTRADAY_HIGH'] = df['HIGH']
-        df['INTRADAY_LOW'] = df['LOW']
+        df['INTRADAY_HIGH'] = high
+        df['INTRADAY_LOW'] = low
         
         # Timestamp
         df['LAST_UPDATE_TIME'] = datetime.now()
         
-        # Handle NaN values in first row
-        df['PREVIOUS_CLOSE'].fillna(0, inplace=True)
-        df['PRICE_CHANGE'].fillna(0, inplace=True)
-        df['PRICE_CHANGE_PCT'].fillna(0, inplace=True)
-        
         return df
         
     except Exception as e:
         logger.error(f"Error extracting data: {e}")
         return None
 
+def insert_rows(conn, cursor, df, table):
+    """Insert the DataFrame with batched executemany (fallback when write_pandas is unavailable)"""
+    # Prepare data for bulk insert - column arrays are converted once and zipped
+    # into row tuples, instead of building a Series per row with iterrows()
+    def floats(col):
+        return df[col].to_numpy(dtype=np.float64).tolist()
+    
+    def nullable_floats(col):
+        values = df[col].to_numpy(dtype=np.float64)
+        return np.where(np.isnan(values), None, values).tolist()
+    
+    data_tuples = list(zip(
+        df['DATE'].tolist(),
+        floats('OPEN'),
+        floats('HIGH'),
+        floats('LOW'),
+        floats('CLOSE'),
+        df['VOLUME'].to_numpy(dtype=np.int64).tolist(),
+        nullable_floats('MA50'),
+        nullable_floats('MA200'),
+        floats('CURRENT_PRICE'),
+        df['UPDATE_COUNT'].to_numpy(dtype=np.int64).tolist(),
+        df['IS_LIVE_DATA'].to_numpy(dtype=bool).tolist(),
+        floats('PREVIOUS_CLOSE'),
+        floats('PRICE_CHANGE'),
+        floats('PRICE_CHANGE_PCT'),
+        floats('INTRADAY_HIGH'),
+        floats('INTRADAY_LOW'),
+        df['LAST_UPDATE_TIME'].dt.to_pydatetime().tolist()
+    ))
+    
+    # Insert in large batches inside one transaction; the connection uses qmark
+    # (server-side) binding, so each batch goes over as a single bound array
+    batch_size = 16000
+    total_inserted = 0
+    
+    logger.info(f"Starting bulk insert of {len(data_tuples)} records...")
+    
+    insert_sql = f"""
+        INSERT INTO {table}
+        (DATE, OPEN, HIGH, LOW, CLOSE, VOLUME, MA50, MA200,
+         CURRENT_PRICE, UPDATE_COUNT, IS_LIVE_DATA, PREVIOUS_CLOSE,
+         PRICE_CHANGE, PRICE_CHANGE_PCT, INTRADAY_HIGH, INTRADAY_LOW,
+         LAST_UPDATE_TIME)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """
+    
+    cursor.execute("BEGIN")
+    for i in range(0, len(data_tuples), batch_size):
+        batch = data_tuples[i:i + batch_size]
+        cursor.executemany(insert_sql, batch)
+    
+        total_inserted += len(batch)
+        # Report every 10th batch (and the last one) rather than after each executemany
+        if (i // batch_size) % 10 == 0 or total_inserted == len(data_tuples):
+            progress = (total_inserted / len(data_tuples)) * 100
+            logger.info(f"Progress: {total_inserted}/{len(data_tuples)} records ({progress:.1f}%)")
+    conn.commit()
+
 def load_to_snowflake(df):
     """Load historical data to Snowflake"""
     if df is None or df.empty:
@@ -96,17 +227,7 @@ def load_to_snowflake(df):
     try:
         # Connect to Snowflake
         logger.info("Connecting to Snowflake...")
-        conn = snowflake.connector.connect(
-            user=os.environ.get('SNOWFLAKE_USER'),
-            password=os.environ.get('SNOWFLAKE_PASSWORD'),
-            account=os.environ.get('SNOWFLAKE_ACCOUNT'),
-            warehouse=os.environ.get('SNOWFLAKE_WAREHOUSE', 'COMPUTE_WH'),
-            database=os.environ.get('SNOWFLAKE_DATABASE', 'WALMART_STOCK_DB'),
-            schema=os.environ.get('SNOWFLAKE_SCHEMA', 'PUBLIC'),
-            login_timeout=60,
-            network_timeout=60,
-            socket_timeout=60
-        )
+        conn = get_conn(paramstyle='qmark')
         cursor = conn.cursor()
         logger.info("✅ Connected to Snowflake")
         
@@ -134,56 +255,29 @@ def load_to_snowflake(df):
         """)
         logger.info("✅ Table verified/created")
         
-        # Clear existing data (optional - comment out if you want to preserve existing)
-        logger.info("⚠️  Clearing existing data...")
-        cursor.execute("TRUNCATE TABLE WALMART_STOCK_DATA")
-        
-        # Prepare data for bulk insert
-        data_tuples = []
-        for _, row in df.iterrows():
-            data_tuples.append((
-                row['DATE'],
-                float(row['OPEN']),
-                float(row['HIGH']),
-                float(row['LOW']),
-                float(row['CLOSE']),
-                int(row['VOLUME']),
-                float(row['MA50']) if pd.notna(row['MA50']) else None,
-                float(row['MA200']) if pd.notna(row['MA200']) else None,
-                float(row['CURRENT_PRICE']),
-                int(row['UPDATE_COUNT']),
-                bool(row['IS_LIVE_DATA']),
-                float(row['PREVIOUS_CLOSE']),
-                float(row['PRICE_CHANGE']),
-                float(row['PRICE_CHANGE_PCT']),
-                float(row['INTRADAY_HIGH']),
-                float(row['INTRADAY_LOW']),
-                row['LAST_UPDATE_TIME']
-            ))
+        # Load into a session-scoped staging table and MERGE on DATE, so a reload
+        # only rewrites rows that are new or have changed instead of truncating
+        cursor.execute(f"CREATE OR REPLACE TEMPORARY TABLE {STAGING_TABLE} LIKE WALMART_STOCK_DATA")
         
-        # Insert in batches
-        batch_size = 1000
-        total_inserted = 0
-        
-        logger.info(f"Starting bulk insert of {len(data_tuples)} records...")
-        
-        insert_sql = """
-            INSERT INTO WALMART_STOCK_DATA 
-            (DATE, OPEN, HIGH, LOW, CLOSE, VOLUME, MA50, MA200,
-             CURRENT_PRICE, UPDATE_COUNT, IS_LIVE_DATA, PREVIOUS_CLOSE,
-             PRICE_CHANGE, PRICE_CHANGE_PCT, INTRADAY_HIGH, INTRADAY_LOW,
-             LAST_UPDATE_TIME)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """
+        if installed_pandas:
+            # Stage the frame as Parquet and ingest it with a single COPY INTO
+            logger.info(f"Starting bulk load of {len(df)} records via stage + COPY INTO...")
+            success, _, nrows, _ = write_pandas(
+                conn, df, STAGING_TABLE,
+                quote_identifiers=False,
+                chunk_size=16000,
+                use_logical_type=True
+            )
+            if not success:
+                raise RuntimeError(f"COPY INTO {STAGING_TABLE} did not complete")
+            logger.info(f"Copied {nrows} records")
+        else:
+            insert_rows(conn, cursor, df, STAGING_TABLE)
         
-        for i in range(0, len(data_tuples), batch_size):
-            batch = data_tuples[i:i + batch_size]
-            cursor.executemany(insert_sql, batch)
-            conn.commit()
-            
-            total_inserted += len(batch)
-            progress = (total_inserted / len(data_tuples)) * 100
-            logger.info(f"Progress: {total_inserted}/{len(data_tuples)} records ({progress:.1f}%)")
+        cursor.execute(MERGE_SQL)
+        inserted, updated = cursor.fetchone()
+        conn.commit()
+        logger.info(f"Merged into WALMART_STOCK_DATA: {inserted} inserted, {updated} updated")
         
         logger.info("✅ All historical data loaded successfully!")
         
@@ -233,10 +327,11 @@ def main():
     ║  This script will:                                       ║
     ║  1. Download ALL Walmart stock data (1972-present)      ║
     ║  2. Calculate moving averages                           ║
-    ║  3. CLEAR existing data in Snowflake                    ║
-    ║  4. Load all historical data                            ║
+    ║  3. Stage the data in a temporary Snowflake table       ║
+    ║  4. MERGE it into WALMART_STOCK_DATA by date            ║
     ║                                                          ║
-    ║  ⚠️  WARNING: This will REPLACE all existing data!      ║
+    ║  ⚠️  WARNING: Existing rows for the same dates are      ║
+    ║      overwritten when their values changed!             ║
     ╚══════════════════════════════════════════════════════════╝
     """)
     
@@ -259,10 +354,16 @@ def main():
     df = extract_all_historical_data()
     
     if df is not None:
-        # Save backup locally
-        backup_file = f"walmart_historical_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-        df.to_csv(backup_file, index=False)
-        logger.info(f"✅ Backup saved to: {backup_file}")
+        # Save backup locally (BACKUP=0 skips it; BACKUP_FORMAT=csv keeps the old text format)
+        if os.environ.get('BACKUP', '1') == '1':
+            backup_name = f"walmart_historical_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+            if os.environ.get('BACKUP_FORMAT', 'parquet').lower() == 'csv':
+                backup_file = f"{backup_name}.csv"
+                df.to_csv(backup_file, index=False)
+            else:
+                backup_file = f"{backup_name}.parquet"
+                df.to_parquet(backup_file, compression='snappy', index=False)
+            logger.info(f"✅ Backup saved to: {backup_file}")
         
         # Load to Snowflake
         logger.info("\nLoading data to Snowflake...")
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""
+snowflake_conn.py - Shared Snowflake connection settings
+Builds the connector arguments once from the environment and hands out a cached connection
+"""
+
+import os
+
+# Built on first use rather than at import, so scripts can load a .env file first
+_CONN_KWARGS = None
+_CONNS = {}  # one cached connection per distinct set of overrides
+
+def connection_kwargs():
+    """Snowflake connect() arguments read from the environment (computed once)"""
+    global _CONN_KWARGS
+    if _CONN_KWARGS is None:
+        _CONN_KWARGS = {
+            'user': os.environ['SNOWFLAKE_USER'],
+            'password': os.environ['SNOWFLAKE_PASSWORD'],
+            'account': os.environ['SNOWFLAKE_ACCOUNT'],
+            'warehouse': os.environ.get('SNOWFLAKE_WAREHOUSE', 'COMPUTE_WH'),
+            'database': os.environ.get('SNOWFLAKE_DATABASE', 'WALMART_STOCK_DB'),
+            'schema': os.environ.get('SNOWFLAKE_SCHEMA', 'PUBLIC'),
+            'login_timeout': 60,
+            'network_timeout': 60,
+            'socket_timeout': 60,
+            'client_session_keep_alive': True,
+        }
+    return _CONN_KWARGS
+
+def get_conn(**overrides):
+    """
+    Return the cached Snowflake connection for these overrides, reconnecting if it was closed
+    Callers asking for different settings get their own connection, never another caller's
+    """
+    key = repr(sorted(overrides.items()))
+    conn = _CONNS.get(key)
+    if conn is None or conn.is_closed():
+        # Imported here so scripts only pay the connector's import cost once they connect
+        import snowflake.connector
+        conn = _CONNS[key] = snowflake.connector.connect(**{**connection_kwargs(), **overrides})
+    return conn
@@ -4,15 +4,23 @@ update_current_day.py - Enhanced with Technical Indicators
 Includes: RSI, 52-Week High/Low, Volume Ratio, Market Cap, and Market Status
 """
 
-import yfinance as yf
-import snowflake.connector
-import pandas as pd
+from snowflake_conn import get_conn
+from _indicators import rsi_last, rolling_mean_tail
 import numpy as np
 from datetime import datetime, timedelta
 import logging
+import asyncio
 import os
 import sys
-import pytz
+from zoneinfo import ZoneInfo
+import requests
+from requests.adapters import HTTPAdapter
+from functools import lru_cache
+
+try:
+    import orjson
+except ImportError:  # fall back to requests' stdlib json decoding
+    orjson = None
 
 # Configure logging
 logging.basicConfig(
@@ -21,139 +29,350 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Ticker handle shared by every yfinance call in this run (see get_ticker)
+_WMT = None
+
+# Yahoo chart endpoint: one request returns the daily bars and the live quote.
+# A single pooled connection is enough for the one call made per run
+_CHART_URL = "https://query1.finance.yahoo.com/v8/finance/chart/WMT"
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+_SESSION.headers['User-Agent'] = 'Mozilla/5.0'  # Yahoo rejects the default requests agent
+
+# Fields of the data dict rounded to cents, in the order get_yahoo_finance_data packs them
+_TWO_DP_FIELDS = (
+    'open', 'high', 'low', 'close', 'current_price', 'previous_close',
+    'price_change', 'fifty_two_week_high', 'fifty_two_week_low', 'volume_ratio',
+    'pct_from_52w_high', 'pct_from_52w_low'
+)
+
+# Daily bars from the last run, so intraday runs only fetch the latest few days
+_BAR_CACHE = os.environ.get('BAR_CACHE', 'wmt_cache.npz')
+_BAR_FIELDS = ('date', 'open', 'high', 'low', 'close', 'volume')
+_SHARES_FIELDS = ('shares', 'shares_date')  # shares outstanding, refreshed once a day
+_BAR_CACHE_MAX_AGE = np.timedelta64(5, 'D')  # a 5d fetch still bridges a long weekend
+
+# Market hours: 9:30 AM - 4:00 PM ET, as minutes since midnight
+_EASTERN = ZoneInfo('America/New_York')
+_MARKET_OPEN_MINUTES = 9 * 60 + 30
+_MARKET_CLOSE_MINUTES = 16 * 60
+
+# Upsert today's row in one round trip; the running HIGH/LOW and the
+# update counter are folded in server-side. Binds by name from the data dict
+_MERGE_SQL = """
+    MERGE INTO WALMART_STOCK_DATA t
+    USING (
+        SELECT
+            TO_DATE(%(date)s) AS DATE,
+            %(open)s AS OPEN,
+            %(high)s AS HIGH,
+            %(low)s AS LOW,
+            %(close)s AS CLOSE,
+            %(volume)s AS VOLUME,
+            %(ma50)s AS MA50,
+            %(ma200)s AS MA200,
+            %(current_price)s AS CURRENT_PRICE,
+            %(previous_close)s AS PREVIOUS_CLOSE,
+            %(price_change)s AS PRICE_CHANGE,
+            %(price_change_pct)s AS PRICE_CHANGE_PCT,
+            %(intraday_high)s AS INTRADAY_HIGH,
+            %(intraday_low)s AS INTRADAY_LOW,
+            %(market_cap_billions)s AS MARKET_CAP_BILLIONS,
+            %(market_status)s AS MARKET_STATUS,
+            %(rsi_14)s AS RSI_14,
+            %(fifty_two_week_high)s AS FIFTY_TWO_WEEK_HIGH,
+            %(fifty_two_week_low)s AS FIFTY_TWO_WEEK_LOW,
+            %(volume_ma_20)s AS VOLUME_MA_20,
+            %(volume_ratio)s AS VOLUME_RATIO,
+            %(pct_from_52w_high)s AS PCT_FROM_52W_HIGH,
+            %(pct_from_52w_low)s AS PCT_FROM_52W_LOW
+    ) src
+    ON t.DATE = src.DATE
+    WHEN MATCHED THEN UPDATE SET
+        OPEN = src.OPEN,
+        HIGH = GREATEST(t.HIGH, src.HIGH),
+        LOW = LEAST(t.LOW, src.LOW),
+        CLOSE = src.CLOSE,
+        VOLUME = src.VOLUME,
+        MA50 = COALESCE(src.MA50, t.MA50),
+        MA200 = COALESCE(src.MA200, t.MA200),
+        CURRENT_PRICE = src.CURRENT_PRICE,
+        UPDATE_COUNT = COALESCE(t.UPDATE_COUNT, 0) + 1,
+        IS_LIVE_DATA = TRUE,
+        PREVIOUS_CLOSE = src.PREVIOUS_CLOSE,
+        PRICE_CHANGE = src.PRICE_CHANGE,
+        PRICE_CHANGE_PCT = src.PRICE_CHANGE_PCT,
+        INTRADAY_HIGH = GREATEST(COALESCE(t.INTRADAY_HIGH, 0), src.INTRADAY_HIGH),
+        INTRADAY_LOW = LEAST(COALESCE(t.INTRADAY_LOW, 999999), src.INTRADAY_LOW),
+        MARKET_CAP_BILLIONS = src.MARKET_CAP_BILLIONS,
+        MARKET_STATUS = src.MARKET_STATUS,
+        RSI_14 = src.RSI_14,
+        FIFTY_TWO_WEEK_HIGH = src.FIFTY_TWO_WEEK_HIGH,
+        FIFTY_TWO_WEEK_LOW = src.FIFTY_TWO_WEEK_LOW,
+        VOLUME_MA_20 = src.VOLUME_MA_20,
+        VOLUME_RATIO = src.VOLUME_RATIO,
+        PCT_FROM_52W_HIGH = src.PCT_FROM_52W_HIGH,
+        PCT_FROM_52W_LOW = src.PCT_FROM_52W_LOW,
+        LAST_UPDATE_TIME = CURRENT_TIMESTAMP
+    WHEN NOT MATCHED THEN INSERT
+        (DATE, OPEN, HIGH, LOW, CLOSE, VOLUME, MA50, MA200,
+         CURRENT_PRICE, UPDATE_COUNT, IS_LIVE_DATA, PREVIOUS_CLOSE,
+         PRICE_CHANGE, PRICE_CHANGE_PCT, INTRADAY_HIGH, INTRADAY_LOW,
+         MARKET_CAP_BILLIONS, MARKET_STATUS, RSI_14, FIFTY_TWO_WEEK_HIGH,
+         FIFTY_TWO_WEEK_LOW, VOLUME_MA_20, VOLUME_RATIO, PCT_FROM_52W_HIGH,
+         PCT_FROM_52W_LOW, LAST_UPDATE_TIME)
+    VALUES
+        (src.DATE, src.OPEN, src.HIGH, src.LOW, src.CLOSE, src.VOLUME, src.MA50, src.MA200,
+         src.CURRENT_PRICE, 1, TRUE, src.PREVIOUS_CLOSE,
+         src.PRICE_CHANGE, src.PRICE_CHANGE_PCT, src.INTRADAY_HIGH, src.INTRADAY_LOW,
+         src.MARKET_CAP_BILLIONS, src.MARKET_STATUS, src.RSI_14, src.FIFTY_TWO_WEEK_HIGH,
+         src.FIFTY_TWO_WEEK_LOW, src.VOLUME_MA_20, src.VOLUME_RATIO, src.PCT_FROM_52W_HIGH,
+         src.PCT_FROM_52W_LOW, CURRENT_TIMESTAMP)
+"""
+
 def calculate_rsi(prices, period=14):
     """
     Calculate Relative Strength Index
     RSI = 100 - (100 / (1 + RS))
-    RS = Average Gain / Average Loss
+    RS = Average Gain / Average Loss (Wilder-smoothed)
     """
     if len(prices) < period + 1:
         return None
-        
-    delta = prices.diff()
-    gain = (delta.where(delta > 0, 0)).rolling(window=period).mean()
-    loss = (-delta.where(delta < 0, 0)).rolling(window=period).mean()
     
-    # Avoid division by zero
-    rs = gain / loss.replace(0, 0.0001)
-    rsi = 100 - (100 / (1 + rs))
+    rsi = rsi_last(np.asarray(prices, dtype=np.float64), period)
+    return None if np.isnan(rsi) else rsi
+
+@lru_cache(maxsize=1)
+def _market_status_at(weekday, minutes):
+    """Market status for a weekday and minutes since midnight ET (repeat calls in the same minute are cached)"""
+    # Check if weekend
+    if weekday >= 5:  # Saturday = 5, Sunday = 6
+        return False, "WEEKEND"
     
-    return rsi.iloc[-1] if not pd.isna(rsi.iloc[-1]) else None
+    if minutes < _MARKET_OPEN_MINUTES:
+        return False, "PRE_MARKET"
+    elif minutes >= _MARKET_CLOSE_MINUTES:
+        return False, "AFTER_HOURS"
+    else:
+        return True, "MARKET_OPEN"
 
 def get_market_status():
     """Check if US market is open"""
-    eastern = pytz.timezone('US/Eastern')
-    now = datetime.now(eastern)
+    now = datetime.now(_EASTERN)
+    is_open, status = _market_status_at(now.weekday(), now.hour * 60 + now.minute)
+    return is_open, status, now
+
+def get_ticker():
+    """yfinance Ticker for WMT - yfinance is only imported once something needs it"""
+    global _WMT
+    if _WMT is None:
+        import yfinance as yf
+        _WMT = yf.Ticker("WMT")
+    return _WMT
+
+def fetch_chart_bars(period='1y'):
+    """
+    Fetch daily bars for the period and the live quote with one Yahoo chart API request
+    OHLC are scaled by adjclose/close, matching yfinance's auto_adjust prices
+    """
+    response = _SESSION.get(
+        _CHART_URL,
+        params={'range': period, 'interval': '1d', 'includeAdjustedClose': 'true'},
+        timeout=10
+    )
+    response.raise_for_status()
+    payload = orjson.loads(response.content) if orjson is not None else response.json()
+    result = payload['chart']['result'][0]
+    ohlcv = result['indicators']['quote'][0]
     
-    # Market hours: 9:30 AM - 4:00 PM ET
-    market_open = now.replace(hour=9, minute=30, second=0, microsecond=0)
-    market_close = now.replace(hour=16, minute=0, second=0, microsecond=0)
+    # Missing prices arrive as null and become NaN here
+    raw_close = np.array(ohlcv['close'], dtype=np.float64)
+    close = np.array(result['indicators']['adjclose'][0]['adjclose'], dtype=np.float64)
+    ratio = close / raw_close
+    bars = {
+        'date': np.array(result['timestamp'], dtype='datetime64[s]').astype('datetime64[D]'),
+        'open': np.array(ohlcv['open'], dtype=np.float64) * ratio,
+        'high': np.array(ohlcv['high'], dtype=np.float64) * ratio,
+        'low': np.array(ohlcv['low'], dtype=np.float64) * ratio,
+        'close': close,
+        'volume': np.array(ohlcv['volume'], dtype=np.float64),
+    }
+    valid = ~np.isnan(close)
+    bars = {key: values[valid] for key, values in bars.items()}
     
-    # Check if weekend
-    if now.weekday() >= 5:  # Saturday = 5, Sunday = 6
-        return False, "WEEKEND", now
+    meta = result['meta']
+    quote = {'price': meta.get('regularMarketPrice'), 'previous_close': meta.get('chartPreviousClose')}
+    return bars, quote
+
+def fetch_yfinance_bars():
+    """Fallback for fetch_chart_bars using yfinance's history and fast_info"""
+    hist_1y = get_ticker().history(period="1y")
+    if hist_1y.empty:
+        return None, None
     
-    # Check market hours
-    if now < market_open:
-        return False, "PRE_MARKET", now
-    elif now > market_close:
-        return False, "AFTER_HOURS", now
-    else:
-        return True, "MARKET_OPEN", now
+    bars = {
+        'date': hist_1y.index.tz_localize(None).to_numpy(dtype='datetime64[D]'),
+        'open': hist_1y['Open'].to_numpy(dtype=np.float64),
+        'high': hist_1y['High'].to_numpy(dtype=np.float64),
+        'low': hist_1y['Low'].to_numpy(dtype=np.float64),
+        'close': hist_1y['Close'].to_numpy(dtype=np.float64),
+        'volume': hist_1y['Volume'].to_numpy(dtype=np.float64),
+    }
+    info = get_ticker().fast_info
+    quote = {'price': info.get('lastPrice'), 'previous_close': info.get('previousClose')}
+    return bars, quote
+
+def load_bar_cache():
+    """Daily bars (and shares outstanding) saved by the previous run, or None if there is no usable cache"""
+    try:
+        with np.load(_BAR_CACHE) as cache:
+            bars = {key: cache[key] for key in _BAR_FIELDS}
+            bars.update((key, cache[key]) for key in _SHARES_FIELDS if key in cache.files)
+            return bars
+    except (OSError, KeyError, ValueError):
+        return None
+
+def save_bar_cache(bars):
+    """Keep the daily bars for the next run (failures only cost a full fetch next time)"""
+    try:
+        np.savez_compressed(_BAR_CACHE, **bars)
+    except OSError as e:
+        logger.warning(f"Could not write bar cache {_BAR_CACHE}: {e}")
+
+def get_daily_bars():
+    """
+    1y of daily bars plus the live quote
+    With a recent cache only the last 5 days are fetched and spliced onto it; the
+    full year is fetched when there is no cache, it is stale, or the overlapping
+    days no longer match (Yahoo re-adjusted the history for a dividend or split).
+    Only completed bars are compared - the cache's last day may have been saved
+    mid-session - and the fresh 5d bars always replace the overlapping days
+    """
+    try:
+        cache = load_bar_cache()
+        today = np.datetime64(datetime.now(_EASTERN).date(), 'D')
+        shares = {key: cache[key] for key in _SHARES_FIELDS if key in cache} if cache is not None else {}
+        if cache is not None and len(cache['date']) and today - cache['date'][-1] <= _BAR_CACHE_MAX_AGE:
+            recent, quote = fetch_chart_bars('5d')
+            if len(recent['date']) and recent['date'][0] <= cache['date'][-1]:
+                settled = min(cache['date'][-1], today)
+                overlap = np.isin(cache['date'], recent['date']) & (cache['date'] < settled)
+                recent_overlap = np.isin(recent['date'], cache['date'][overlap])
+                if np.allclose(cache['close'][overlap], recent['close'][recent_overlap]):
+                    keep = (cache['date'] < recent['date'][0]) & (cache['date'] > recent['date'][-1] - 365)
+                    bars = {key: np.concatenate((cache[key][keep], recent[key])) for key in _BAR_FIELDS}
+                    bars.update(shares)
+                    save_bar_cache(bars)
+                    return bars, quote
+            logger.info("Cached bars are out of date; fetching the full year")
+        
+        bars, quote = fetch_chart_bars()
+        bars.update(shares)
+        save_bar_cache(bars)
+        return bars, quote
+    except Exception as e:
+        logger.warning(f"Yahoo chart API failed ({e}); falling back to yfinance")
+        return fetch_yfinance_bars()
+
+def get_market_cap(price, bars):
+    """
+    Market cap from the shares outstanding kept in the bar cache
+    The count barely moves, so yfinance (and its cookie/crumb and share-count
+    requests) is only hit once a day; if that fails the cached count is used
+    """
+    today = np.datetime64(datetime.now(_EASTERN).date(), 'D')
+    shares = bars.get('shares')
+    if shares is None or bars['shares_date'] < today:
+        try:
+            fresh = get_ticker().fast_info.get('shares')
+            if fresh:
+                shares = bars['shares'] = np.float64(fresh)
+                bars['shares_date'] = today
+                save_bar_cache(bars)
+        except Exception as e:
+            logger.warning(f"Could not fetch shares outstanding: {e}")
+    return float(shares or 0) * price
 
 def get_yahoo_finance_data():
     """Fetch current Walmart data from Yahoo Finance with technical indicators"""
     try:
         logger.info("Fetching Walmart data from Yahoo Finance...")
-        wmt = yf.Ticker("WMT")
         
         # Get market status
         is_open, market_status, current_time = get_market_status()
         
-        # Get 1 year of data for 52-week calculations
-        hist_1y = wmt.history(period="1y")
+        # Get 1 year of daily bars (for 52-week calculations) plus the live quote
+        bars, quote = get_daily_bars()
         
-        if hist_1y.empty:
+        if bars is None or len(bars['close']) == 0:
             logger.error("No data received from Yahoo Finance")
             return None
         
+        # Every indicator below works on these arrays and only needs the value at the last row
+        close = bars['close']
+        high = bars['high']
+        low = bars['low']
+        volume = bars['volume']
+        
         # Get the most recent trading day's data
-        latest_data = hist_1y.iloc[-1]
-        latest_date = hist_1y.index[-1].strftime('%Y-%m-%d')
+        latest_date = str(bars['date'][-1])
         
-        # Get info including market cap
-        info = wmt.info
-        current_price = info.get('currentPrice', latest_data['Close'])
-        market_cap = info.get('marketCap', 0)
-        market_cap_billions = market_cap / 1_000_000_000
+        current_price = quote.get('price') or close[-1]
+        market_cap_billions = get_market_cap(current_price, bars) / 1_000_000_000
         
         # Calculate previous close
-        if len(hist_1y) >= 2:
-            previous_close = hist_1y.iloc[-2]['Close']
+        if len(close) >= 2:
+            previous_close = close[-2]
         else:
-            previous_close = info.get('previousClose', latest_data['Open'])
+            previous_close = quote.get('previous_close') or bars['open'][-1]
         
         # Calculate price changes
         price_change = current_price - previous_close
         price_change_pct = (price_change / previous_close) * 100 if previous_close > 0 else 0
         
         # Calculate RSI
-        rsi_14 = calculate_rsi(hist_1y['Close'])
+        rsi_14 = calculate_rsi(close)
         
         # Calculate 52-week high and low
-        fifty_two_week_high = hist_1y['High'].max()
-        fifty_two_week_low = hist_1y['Low'].min()
+        fifty_two_week_high = float(np.max(high))
+        fifty_two_week_low = float(np.min(low))
         
         # Calculate percentage from 52-week high/low
         pct_from_52w_high = ((current_price - fifty_two_week_high) / fifty_two_week_high) * 100
         pct_from_52w_low = ((current_price - fifty_two_week_low) / fifty_two_week_low) * 100
         
         # Calculate volume metrics
-        volume_ma_20 = hist_1y['Volume'].rolling(window=20).mean().iloc[-1]
-        volume_ratio = latest_data['Volume'] / volume_ma_20 if volume_ma_20 > 0 else 1
+        volume_ma_20 = rolling_mean_tail(volume, 20)
+        volume_ratio = volume[-1] / volume_ma_20 if volume_ma_20 > 0 else 1
         
-        # Prepare data
-        data = {
+        # Prepare data - the two-decimal fields are rounded with one np.round call
+        two_dp = np.round(np.array([
+            bars['open'][-1], high[-1], low[-1], close[-1], current_price, previous_close,
+            price_change, fifty_two_week_high, fifty_two_week_low, volume_ratio,
+            pct_from_52w_high, pct_from_52w_low
+        ], dtype=np.float64), 2).tolist()
+        data = dict(zip(_TWO_DP_FIELDS, two_dp))
+        data.update({
             'date': latest_date,
-            'open': round(latest_data['Open'], 2),
-            'high': round(latest_data['High'], 2),
-            'low': round(latest_data['Low'], 2),
-            'close': round(latest_data['Close'], 2),
-            'volume': int(latest_data['Volume']),
-            'current_price': round(current_price, 2),
-            'previous_close': round(previous_close, 2),
-            'price_change': round(price_change, 2),
-            'price_change_pct': round(price_change_pct, 4),
-            'intraday_high': round(latest_data['High'], 2),
-            'intraday_low': round(latest_data['Low'], 2),
-            'market_cap_billions': round(market_cap_billions, 3),
+            'volume': int(volume[-1]),
+            'price_change_pct': round(float(price_change_pct), 4),
+            'intraday_high': data['high'],
+            'intraday_low': data['low'],
+            'market_cap_billions': round(float(market_cap_billions), 3),
             'market_status': market_status,
             # New technical indicators
-            'rsi_14': round(rsi_14, 2) if rsi_14 else None,
-            'fifty_two_week_high': round(fifty_two_week_high, 2),
-            'fifty_two_week_low': round(fifty_two_week_low, 2),
-            'volume_ma_20': int(volume_ma_20),
-            'volume_ratio': round(volume_ratio, 2),
-            'pct_from_52w_high': round(pct_from_52w_high, 2),
-            'pct_from_52w_low': round(pct_from_52w_low, 2)
-        }
+            'rsi_14': round(float(rsi_14), 2) if rsi_14 is not None else None,
+            'volume_ma_20': int(volume_ma_20)
+        })
         
-        # Calculate moving averages
-        if len(hist_1y) >= 50:
-            ma50 = hist_1y['Close'].rolling(window=50).mean().iloc[-1]
-            data['ma50'] = round(ma50, 2)
-        else:
-            data['ma50'] = None
-            
-        if len(hist_1y) >= 200:
-            ma200 = hist_1y['Close'].rolling(window=200).mean().iloc[-1]
-            data['ma200'] = round(ma200, 2)
-        else:
-            data['ma200'] = None
+        # Calculate moving averages - only the latest value is stored, so average
+        # the trailing window directly instead of rolling over the whole year
+        data['ma50'] = round(float(rolling_mean_tail(close, 50)), 2) if len(close) >= 50 else None
+        data['ma200'] = round(float(rolling_mean_tail(close, 200)), 2) if len(close) >= 200 else None
         
         logger.info(f"✅ Retrieved data for {latest_date}: ${current_price:.2f} ({price_change:+.2f}, {price_change_pct:+.2f}%)")
         logger.info(f"   Market Cap: ${market_cap_billions:.3f}B | Status: {market_status}")
-        logger.info(f"   RSI: {rsi_14:.2f} | 52W Range: ${fifty_two_week_low:.2f}-${fifty_two_week_high:.2f}")
+        logger.info(f"   RSI: {data['rsi_14'] if rsi_14 is not None else 'N/A'} | 52W Range: ${fifty_two_week_low:.2f}-${fifty_two_week_high:.2f}")
         logger.info(f"   Volume Ratio: {volume_ratio:.2f}x average")
         
         return data
@@ -162,126 +381,63 @@ def get_yahoo_finance_data():
         logger.error(f"Error fetching Yahoo Finance data: {e}")
         return None
 
-def update_snowflake(data):
+def connect_snowflake():
+    """Open the Snowflake connection for the update (None if the connection fails)"""
+    try:
+        logger.info("Connecting to Snowflake...")
+        # One MERGE and a commit: no heartbeat thread, and fail fast on a stalled socket
+        conn = get_conn(client_session_keep_alive=False, network_timeout=30, socket_timeout=30)
+        logger.info("✅ Connected to Snowflake")
+        return conn
+    except Exception as e:
+        logger.error(f"Snowflake connection error: {e}")
+        return None
+
+def update_snowflake(conn, data):
     """Update Snowflake with the latest data including technical indicators"""
-    if not data:
+    if not data or conn is None:
         return False
     
     try:
-        # Connect to Snowflake
-        logger.info("Connecting to Snowflake...")
-        conn = snowflake.connector.connect(
-            user=os.environ['SNOWFLAKE_USER'],
-            password=os.environ['SNOWFLAKE_PASSWORD'],
-            account=os.environ['SNOWFLAKE_ACCOUNT'],
-            warehouse=os.environ.get('SNOWFLAKE_WAREHOUSE', 'COMPUTE_WH'),
-            database=os.environ.get('SNOWFLAKE_DATABASE', 'WALMART_STOCK_DB'),
-            schema=os.environ.get('SNOWFLAKE_SCHEMA', 'PUBLIC'),
-            login_timeout=60,
-            network_timeout=60,
-            socket_timeout=60
-        )
         cursor = conn.cursor()
-        logger.info("✅ Connected to Snowflake")
+        cursor.execute(_MERGE_SQL, data)
         
-        # Check if record exists for today
-        cursor.execute(
-            "SELECT UPDATE_COUNT FROM WALMART_STOCK_DATA WHERE DATE = %s",
-            (data['date'],)
-        )
-        result = cursor.fetchone()
-        
-        if result:
-            # Update existing record
-            update_count = result[0] + 1
-            cursor.execute("""
-                UPDATE WALMART_STOCK_DATA SET
-                    OPEN = %s,
-                    HIGH = GREATEST(HIGH, %s),
-                    LOW = LEAST(LOW, %s),
-                    CLOSE = %s,
-                    VOLUME = %s,
-                    MA50 = COALESCE(%s, MA50),
-                    MA200 = COALESCE(%s, MA200),
-                    CURRENT_PRICE = %s,
-                    UPDATE_COUNT = %s,
-                    IS_LIVE_DATA = TRUE,
-                    PREVIOUS_CLOSE = %s,
-                    PRICE_CHANGE = %s,
-                    PRICE_CHANGE_PCT = %s,
-                    INTRADAY_HIGH = GREATEST(COALESCE(INTRADAY_HIGH, 0), %s),
-                    INTRADAY_LOW = LEAST(COALESCE(INTRADAY_LOW, 999999), %s),
-                    MARKET_CAP_BILLIONS = %s,
-                    MARKET_STATUS = %s,
-                    RSI_14 = %s,
-                    FIFTY_TWO_WEEK_HIGH = %s,
-                    FIFTY_TWO_WEEK_LOW = %s,
-                    VOLUME_MA_20 = %s,
-                    VOLUME_RATIO = %s,
-                    PCT_FROM_52W_HIGH = %s,
-                    PCT_FROM_52W_LOW = %s,
-                    LAST_UPDATE_TIME = CURRENT_TIMESTAMP
-                WHERE DATE = %s
-            """, (
-                data['open'], data['high'], data['low'], data['close'],
-                data['volume'], data['ma50'], data['ma200'],
-                data['current_price'], update_count,
-                data['previous_close'], data['price_change'], data['price_change_pct'],
-                data['intraday_high'], data['intraday_low'],
-                data['market_cap_billions'], data['market_status'],
-                data['rsi_14'], data['fifty_two_week_high'], data['fifty_two_week_low'],
-                data['volume_ma_20'], data['volume_ratio'],
-                data['pct_from_52w_high'], data['pct_from_52w_low'],
-                data['date']
-            ))
-            logger.info(f"✅ Updated record for {data['date']} (update #{update_count})")
+        # MERGE reports (rows inserted, rows updated)
+        inserted, updated = cursor.fetchone()
+        if updated:
+            logger.info(f"✅ Updated record for {data['date']}")
         else:
-            # Insert new record
-            cursor.execute("""
-                INSERT INTO WALMART_STOCK_DATA 
-                (DATE, OPEN, HIGH, LOW, CLOSE, VOLUME, MA50, MA200,
-                 CURRENT_PRICE, UPDATE_COUNT, IS_LIVE_DATA, PREVIOUS_CLOSE,
-                 PRICE_CHANGE, PRICE_CHANGE_PCT, INTRADAY_HIGH, INTRADAY_LOW,
-                 MARKET_CAP_BILLIONS, MARKET_STATUS, RSI_14, FIFTY_TWO_WEEK_HIGH,
-                 FIFTY_TWO_WEEK_LOW, VOLUME_MA_20, VOLUME_RATIO, PCT_FROM_52W_HIGH,
-                 PCT_FROM_52W_LOW, LAST_UPDATE_TIME)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, 1, TRUE, %s, %s, %s, %s, %s, 
-                        %s, %s, %s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
-            """, (
-                data['date'], data['open'], data['high'], data['low'],
-                data['close'], data['volume'], data['ma50'], data['ma200'],
-                data['current_price'], data['previous_close'],
-                data['price_change'], data['price_change_pct'],
-                data['intraday_high'], data['intraday_low'],
-                data['market_cap_billions'], data['market_status'],
-                data['rsi_14'], data['fifty_two_week_high'], data['fifty_two_week_low'],
-                data['volume_ma_20'], data['volume_ratio'],
-                data['pct_from_52w_high'], data['pct_from_52w_low']
-            ))
             logger.info(f"✅ Inserted new record for {data['date']}")
         
         conn.commit()
         
-        # Log summary for GitHub Actions
-        print(f"\n{'='*70}")
-        print(f"UPDATE SUMMARY - {data['date']}")
-        print(f"{'='*70}")
-        print(f"Current Price: ${data['current_price']:.2f}")
-        print(f"Change: ${data['price_change']:+.2f} ({data['price_change_pct']:+.2f}%)")
-        print(f"Day Range: ${data['low']:.2f} - ${data['high']:.2f}")
-        print(f"Volume: {data['volume']:,} (Ratio: {data['volume_ratio']:.2f}x)")
-        print(f"Market Cap: ${data['market_cap_billions']:.3f}B")
-        print(f"Market Status: {data['market_status']}")
-        print(f"\nTechnical Indicators:")
-        print(f"RSI(14): {data['rsi_14'] or 'N/A'}")
-        print(f"52-Week Range: ${data['fifty_two_week_low']:.2f} - ${data['fifty_two_week_high']:.2f}")
-        print(f"% from 52W High: {data['pct_from_52w_high']:.2f}%")
-        print(f"% from 52W Low: {data['pct_from_52w_low']:.2f}%")
+        # Log summary for GitHub Actions - built up front and written in one call
+        rule = '=' * 70
+        lines = [
+            "",
+            rule,
+            f"UPDATE SUMMARY - {data['date']}",
+            rule,
+            f"Current Price: ${data['current_price']:.2f}",
+            f"Change: ${data['price_change']:+.2f} ({data['price_change_pct']:+.2f}%)",
+            f"Day Range: ${data['low']:.2f} - ${data['high']:.2f}",
+            f"Volume: {data['volume']:,} (Ratio: {data['volume_ratio']:.2f}x)",
+            f"Market Cap: ${data['market_cap_billions']:.3f}B",
+            f"Market Status: {data['market_status']}",
+            "",
+            "Technical Indicators:",
+            f"RSI(14): {data['rsi_14'] if data['rsi_14'] is not None else 'N/A'}",
+            f"52-Week Range: ${data['fifty_two_week_low']:.2f} - ${data['fifty_two_week_high']:.2f}",
+            f"% from 52W High: {data['pct_from_52w_high']:.2f}%",
+            f"% from 52W Low: {data['pct_from_52w_low']:.2f}%",
+        ]
         if data['ma50']:
-            print(f"MA50: ${data['ma50']:.2f}")
+            lines.append(f"MA50: ${data['ma50']:.2f}")
         if data['ma200']:
-            print(f"MA200: ${data['ma200']:.2f}")
-        print(f"{'='*70}\n")
+            lines.append(f"MA200: ${data['ma200']:.2f}")
+        lines += [rule, "", ""]
+        sys.stdout.write("\n".join(lines))
+        sys.stdout.flush()
         
         cursor.close()
         conn.close()
@@ -289,10 +445,17 @@ def update_snowflake(data):
         
     except Exception as e:
         logger.error(f"Snowflake error: {e}")
-        if 'conn' in locals():
-            conn.rollback()
+        conn.rollback()
         return False
 
+async def fetch_and_connect():
+    """Fetch from Yahoo Finance and connect to Snowflake at the same time - the two
+    network waits are independent, so the connect overlaps the Yahoo round trips"""
+    return await asyncio.gather(
+        asyncio.to_thread(get_yahoo_finance_data),
+        asyncio.to_thread(connect_snowflake)
+    )
+
 def main():
     """Main execution function"""
     logger.info("="*60)
@@ -305,10 +468,10 @@ def main():
     logger.info(f"Current Time (ET): {current_time.strftime('%Y-%m-%d %H:%M:%S')}")
     
     # Always try to update data (useful for after-hours or if running late)
-    data = get_yahoo_finance_data()
+    data, conn = asyncio.run(fetch_and_connect())
     
     if data:
-        success = update_snowflake(data)
+        success = update_snowflake(conn, data)
         if success:
             logger.info("✅ Update completed successfully!")
             sys.exit(0)
@@ -317,6 +480,8 @@ def main():
             sys.exit(1)
     else:
         logger.error("❌ No data retrieved from Yahoo Finance")
+        if conn is not None:
+            conn.close()
         sys.exit(1)
 
 if __name__ == "__main__":